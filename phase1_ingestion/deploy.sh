@@ -104,9 +104,18 @@ echo "=========================================="
 echo "Deploying Lambda Functions"
 echo "=========================================="
 
+# Dependencies not included in the Lambda runtime (built for python3.11 x86_64)
+echo "Installing Lambda dependencies..."
+cd "$(dirname "$0")"
+rm -rf lambda_deps
+pip install --quiet --target lambda_deps \
+    --platform manylinux2014_x86_64 --python-version 3.11 --only-binary=:all: \
+    orjson
+echo -e "${GREEN}✓ Dependencies installed${NC}"
+
 # Upload Handler
 echo "Packaging upload handler..."
-cd "$(dirname "$0")"
+(cd lambda_deps && zip -qr ../upload_handler.zip .)
 zip -q upload_handler.zip lambda_upload_handler.py
 UPLOAD_FUNCTION="${PROJECT_NAME}-upload-handler"
 
@@ -120,6 +129,7 @@ echo -e "${GREEN}✓ Upload handler deployed${NC}"
 
 # Import Monitor
 echo "Packaging import monitor..."
+(cd lambda_deps && zip -qr ../import_monitor.zip .)
 zip -q import_monitor.zip lambda_import_monitor.py
 MONITOR_FUNCTION="${PROJECT_NAME}-import-monitor"
 
@@ -131,8 +141,22 @@ aws lambda update-function-code \
 
 echo -e "${GREEN}✓ Import monitor deployed${NC}"
 
+# Workflow Dispatcher
+echo "Packaging workflow dispatcher..."
+(cd lambda_deps && zip -qr ../workflow_dispatcher.zip .)
+zip -q workflow_dispatcher.zip lambda_workflow_dispatcher.py
+DISPATCHER_FUNCTION="${PROJECT_NAME}-workflow-dispatcher"
+
+echo "Deploying workflow dispatcher..."
+aws lambda update-function-code \
+    --function-name $DISPATCHER_FUNCTION \
+    --zip-file fileb://workflow_dispatcher.zip \
+    --region $REGION > /dev/null
+
+echo -e "${GREEN}✓ Workflow dispatcher deployed${NC}"
+
 # Cleanup
-rm -f upload_handler.zip import_monitor.zip
+rm -rf upload_handler.zip import_monitor.zip workflow_dispatcher.zip lambda_deps
 
 echo ""
 echo "=========================================="
@@ -1,86 +1,184 @@
 """
 Lambda Function: HealthImaging Import Monitor
-Triggered by: Step Functions (polling)
-Purpose: Check if HealthImaging import job is complete
+Triggered by: Step Functions (task token) and EventBridge (HealthImaging import job events)
+Purpose: Resume the Step Functions workflow when the HealthImaging import job finishes
 """
 
-import json
+import orjson
 import boto3
 import os
+from botocore.config import Config
 
-healthimaging_client = boto3.client('medical-imaging')
-dynamodb = boto3.resource('dynamodb')
+# Larger connection pool, TCP keepalive and adaptive retries for AWS clients
+boto_config = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 3}
+)
+
+dynamodb_client = boto3.client('dynamodb', config=boto_config)
+sfn_client = boto3.client('stepfunctions', config=boto_config)
 
 METADATA_TABLE = os.environ['DYNAMODB_TABLE']
 
+# Import job states reported once the job is done
+FINAL_JOB_STATUSES = ('COMPLETED', 'FAILED')
+
 def lambda_handler(event, context):
     """
-    Check HealthImaging import job status
-    Returns: job status for Step Functions decision
+    Handle HealthImaging import job events and Step Functions task tokens
+    Whichever arrives last resumes the waiting workflow
     """
     try:
-        study_id = event['study_id']
-        import_job_id = event['import_job_id']
-        datastore_id = event['datastore_id']
-        
-        # Get import job status
-        response = healthimaging_client.get_dicom_import_job(
-            datastoreId=datastore_id,
-            jobId=import_job_id
-        )
-        
-        job_status = response['jobProperties']['jobStatus']
-        
-        # Update DynamoDB
-        table = dynamodb.Table(METADATA_TABLE)
-        table.update_item(
-            Key={'study_id': study_id},
-            UpdateExpression='SET import_status = :status',
-            ExpressionAttributeValues={':status': job_status}
-        )
+        if event.get('source') == 'aws.medical-imaging':
+            item = save_import_status(event['detail'])
+            if item is None:
+                # Studies are saved before their import job starts, so the job
+                # was not started by the upload handler
+                print(f"WARNING: no study for import job {event['detail'].get('jobName')!r}, event ignored")
+                return {'ignored': True}
+        else:
+            item = save_task_token(event['study_id'], event['task_token'])
+            if item is None:
+                # Fail the waiting task now instead of at its timeout
+                print(f"WARNING: no study {event['study_id']!r} for the workflow task")
+                sfn_client.send_task_failure(
+                    taskToken=event['task_token'],
+                    error='StudyNotFound',
+                    cause=f"Study {event['study_id']} does not exist"
+                )
+                return {'study_id': event['study_id'], 'job_status': None}
         
-        # Extract image set ID if completed
-        image_set_id = None
-        if job_status == 'COMPLETED':
-            # Get the imported image set ID
-            image_set_id = response['jobProperties'].get('outputS3Uri', '').split('/')[-2]
-            
-            # Update DynamoDB with image set ID
-            table.update_item(
-                Key={'study_id': study_id},
-                UpdateExpression='SET image_set_id = :id, #st = :status',
-                ExpressionAttributeNames={'#st': 'status'},
-                ExpressionAttributeValues={
-                    ':id': image_set_id,
-                    ':status': 'READY_FOR_ANALYSIS'
-                }
-            )
+        if item.get('task_token') and item.get('import_status') in FINAL_JOB_STATUSES:
+            notify_workflow(item)
         
         return {
-            'study_id': study_id,
-            'import_job_id': import_job_id,
-            'datastore_id': datastore_id,
-            'job_status': job_status,
-            'image_set_id': image_set_id,
-            'is_complete': job_status == 'COMPLETED',
-            'has_error': job_status == 'FAILED'
+            'study_id': item['study_id'],
+            'job_status': item.get('import_status')
         }
-        
+    
     except Exception as e:
-        print(f"Error checking import status: {str(e)}")
-        return {
-            'job_status': 'ERROR',
-            'error': str(e),
-            'is_complete': False,
-            'has_error': True
-        }
+        print(f"Error handling import status: {str(e)}")
+        raise
+
+
+def save_import_status(detail):
+    """
+    Store the import job status from a HealthImaging EventBridge event
+    The import job is started with the study ID as job name
+    Returns None for jobs that don't belong to a known study
+    """
+    study_id = detail.get('jobName')
+    if not study_id:
+        return None
+    job_status = detail['jobStatus']
+    
+    if job_status == 'COMPLETED':
+        # Get the imported image set ID
+        image_set_id = detail.get('outputS3Uri', '').split('/')[-2]
+        
+        # Update DynamoDB with import status and image set ID in one write
+        return update_study(
+            study_id,
+            UpdateExpression='SET import_status = :js, image_set_id = :id, #st = :status',
+            ExpressionAttributeNames={'#st': 'status'},
+            ExpressionAttributeValues={
+                ':js': string_value(job_status),
+                ':id': string_value(image_set_id),
+                ':status': string_value('READY_FOR_ANALYSIS')
+            }
+        )
+    
+    # Update DynamoDB
+    return update_study(
+        study_id,
+        UpdateExpression='SET import_status = :status',
+        ExpressionAttributeValues={':status': string_value(job_status)}
+    )
+
+
+def save_task_token(study_id, task_token):
+    """
+    Store the Step Functions task token the workflow is waiting on
+    """
+    return update_study(
+        study_id,
+        UpdateExpression='SET task_token = :token',
+        ExpressionAttributeValues={':token': string_value(task_token)}
+    )
+
+
+def update_study(study_id, **update):
+    """
+    Update an existing study item and return its new attributes
+    Returns None when no such study exists, so stray events never create items
+    """
+    try:
+        response = dynamodb_client.update_item(
+            TableName=METADATA_TABLE,
+            Key={'study_id': string_value(study_id)},
+            ConditionExpression='attribute_exists(study_id)',
+            ReturnValues='ALL_NEW',
+            **update
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return None
+    
+    return from_attribute_values(response['Attributes'])
+
+
+def notify_workflow(item):
+    """
+    Send the import job result to the waiting Step Functions task
+    """
+    try:
+        if item['import_status'] == 'COMPLETED':
+            sfn_client.send_task_success(
+                taskToken=item['task_token'],
+                output=orjson.dumps({
+                    'study_id': item['study_id'],
+                    'import_job_id': item.get('import_job_id'),
+                    'datastore_id': item.get('datastore_id'),
+                    'job_status': item['import_status'],
+                    'image_set_id': item.get('image_set_id')
+                }).decode()
+            )
+        else:
+            sfn_client.send_task_failure(
+                taskToken=item['task_token'],
+                error='ImportJobFailed',
+                cause='HealthImaging import job failed'
+            )
+    except (sfn_client.exceptions.TaskTimedOut, sfn_client.exceptions.InvalidToken):
+        # Both invocations saw the final status and the other one already answered
+        print(f"Task for {item['study_id']} already resolved")
+
+
+def string_value(value):
+    """
+    DynamoDB string AttributeValue
+    """
+    return {'S': value}
+
+
+def from_attribute_values(attributes):
+    """
+    Plain dict from DynamoDB AttributeValues (study items only hold strings)
+    """
+    return {k: v['S'] for k, v in attributes.items() if 'S' in v}
 
 
 if __name__ == "__main__":
     test_event = {
-        'study_id': 'STUDY-abc123',
-        'import_job_id': '12345678901234567890123456789012',
-        'datastore_id': '1234567890abcdef1234567890abcdef'
+        'source': 'aws.medical-imaging',
+        'detail-type': 'Import Job Completed',
+        'detail': {
+            'datastoreId': '1234567890abcdef1234567890abcdef',
+            'jobId': '12345678901234567890123456789012',
+            'jobName': 'STUDY-abc123',
+            'jobStatus': 'COMPLETED',
+            'outputS3Uri': 's3://bucket/healthimaging-output/STUDY-abc123/'
+        }
     }
     
     print(lambda_handler(test_event, None))
@@ -1,33 +1,58 @@
 """
 Lambda Function: DICOM Upload Handler
-Triggered by: API Gateway POST request
-Purpose: Validate and initiate DICOM ingestion to AWS HealthImaging
+Triggered by: API Gateway POST request (/upload-url and /upload)
+Purpose: Issue presigned upload URLs, validate and initiate DICOM ingestion to AWS HealthImaging
 """
 
-import json
+import orjson
+import base64
 import boto3
 import os
+import re
+from botocore.config import Config
 from datetime import datetime
 import uuid
 
-s3_client = boto3.client('s3')
-healthimaging_client = boto3.client('medical-imaging')
-dynamodb = boto3.resource('dynamodb')
-sfn_client = boto3.client('stepfunctions')
+# Larger connection pool, TCP keepalive and adaptive retries for AWS clients
+boto_config = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 3}
+)
+
+# Presigned URLs must be SigV4 on the regional endpoint, new buckets reject SigV2
+s3_client = boto3.client(
+    's3',
+    region_name=os.environ.get('AWS_REGION'),
+    config=boto_config.merge(Config(
+        signature_version='s3v4',
+        s3={'addressing_style': 'virtual', 'us_east_1_regional_endpoint': 'regional'}
+    ))
+)
+healthimaging_client = boto3.client('medical-imaging', config=boto_config)
+dynamodb_client = boto3.client('dynamodb', config=boto_config)
 
 # Environment variables
 UPLOAD_BUCKET = os.environ['UPLOAD_BUCKET']
 DATASTORE_ID = os.environ['HEALTHIMAGING_DATASTORE_ID']
 METADATA_TABLE = os.environ['DYNAMODB_TABLE']
-STEP_FUNCTION_ARN = os.environ['STEP_FUNCTION_ARN']
+
+# Validity of presigned upload URLs (seconds)
+UPLOAD_URL_EXPIRY = 3600
+
+# Keys issued by create_upload_url: one folder per upload
+UPLOAD_KEY_PATTERN = re.compile(r'uploads/[0-9a-f]{32}/[^/]+')
 
 def lambda_handler(event, context):
     """
     Handle DICOM file upload and initiate processing pipeline
     """
+    if event.get('routeKey') == 'POST /upload-url':
+        return create_upload_url(event)
+    
     try:
         # Parse request
-        body = json.loads(event.get('body', '{}'))
+        body = orjson.loads(event.get('body', '{}'))
         
         # Extract metadata
         patient_id = body.get('patient_id')
@@ -38,31 +63,28 @@ def lambda_handler(event, context):
         if not patient_id or not file_key:
             return {
                 'statusCode': 400,
-                'body': json.dumps({'error': 'patient_id and file_key are required'})
+                'body': orjson.dumps({'error': 'patient_id and file_key are required'}).decode()
             }
         
-        # Generate unique study ID
-        study_id = f"STUDY-{uuid.uuid4().hex[:12]}"
-        timestamp = datetime.utcnow().isoformat()
-        
-        # Verify DICOM file exists in S3
-        try:
-            s3_client.head_object(Bucket=UPLOAD_BUCKET, Key=file_key)
-        except:
+        # The import job takes the whole folder of the key, so only upload
+        # folders issued by POST /upload-url are accepted
+        if not UPLOAD_KEY_PATTERN.fullmatch(file_key):
             return {
-                'statusCode': 404,
-                'body': json.dumps({'error': 'DICOM file not found in S3'})
+                'statusCode': 400,
+                'body': orjson.dumps({'error': 'file_key must be a key returned by POST /upload-url'}).decode()
             }
         
-        # Start HealthImaging import job
-        # HealthImaging expects a folder path, not a single file
-        folder_path = '/'.join(file_key.split('/')[:-1]) + '/'
-        import_response = start_healthimaging_import(
-            study_id=study_id,
-            s3_uri=f"s3://{UPLOAD_BUCKET}/{folder_path}"
-        )
+        # Generate unique study ID
+        study_id = f"STUDY-{base64.b32encode(uuid.uuid4().bytes[:8]).rstrip(b'=').decode()}"
+        timestamp = datetime.utcnow().isoformat()
+        
+        # The file was uploaded with a URL from create_upload_url, a missing
+        # file fails the import job instead of being checked here
         
-        # Store metadata in DynamoDB
+        # Store metadata in DynamoDB before the import job starts, so the
+        # import job events always find the study
+        # The new item starts the Step Functions workflow through the table
+        # stream (lambda_workflow_dispatcher.py), off the request path
         metadata = {
             'study_id': study_id,
             'patient_id': patient_id,
@@ -71,15 +93,27 @@ def lambda_handler(event, context):
             's3_bucket': UPLOAD_BUCKET,
             's3_key': file_key,
             'datastore_id': DATASTORE_ID,
-            'import_job_id': import_response['jobId'],
             'status': 'IMPORTING',
             'processing_stage': 'ingestion'
         }
         
         save_to_dynamodb(metadata)
         
-        # Trigger Step Functions workflow (will wait for import completion)
-        trigger_workflow(study_id, metadata)
+        # Start HealthImaging import job
+        # HealthImaging expects a folder path, not a single file
+        folder_path = '/'.join(file_key.split('/')[:-1]) + '/'
+        try:
+            import_response = start_healthimaging_import(
+                study_id=study_id,
+                s3_uri=f"s3://{UPLOAD_BUCKET}/{folder_path}"
+            )
+        except Exception:
+            # The workflow is already started, the import monitor fails its
+            # task when the token finds the failed import status
+            update_study(study_id, import_status='FAILED', status='IMPORT_FAILED')
+            raise
+        
+        update_study(study_id, import_job_id=import_response['jobId'])
         
         return {
             'statusCode': 202,
@@ -87,19 +121,62 @@ def lambda_handler(event, context):
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'message': 'DICOM ingestion started',
                 'study_id': study_id,
                 'import_job_id': import_response['jobId'],
                 'status': 'processing'
-            })
+            }).decode()
+        }
+        
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return {
+            'statusCode': 500,
+            'body': orjson.dumps({'error': str(e)}).decode()
+        }
+
+
+def create_upload_url(event):
+    """
+    Return a presigned S3 PUT URL and the key to pass to POST /upload
+    Each upload gets its own folder so the import job only picks up this file
+    """
+    try:
+        body = orjson.loads(event.get('body', '{}'))
+        file_name = body.get('file_name')
+        
+        if not file_name:
+            return {
+                'statusCode': 400,
+                'body': orjson.dumps({'error': 'file_name is required'}).decode()
+            }
+        
+        file_key = f"uploads/{uuid.uuid4().hex}/{os.path.basename(file_name)}"
+        upload_url = s3_client.generate_presigned_url(
+            'put_object',
+            Params={'Bucket': UPLOAD_BUCKET, 'Key': file_key},
+            ExpiresIn=UPLOAD_URL_EXPIRY
+        )
+        
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': orjson.dumps({
+                'upload_url': upload_url,
+                'file_key': file_key,
+                'expires_in': UPLOAD_URL_EXPIRY
+            }).decode()
         }
         
     except Exception as e:
         print(f"Error: {str(e)}")
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': orjson.dumps({'error': str(e)}).decode()
         }
 
 
@@ -107,7 +184,9 @@ def start_healthimaging_import(study_id, s3_uri):
     """
     Start AWS HealthImaging import job
     """
+    # The job name carries the study ID into HealthImaging import job events
     response = healthimaging_client.start_dicom_import_job(
+        jobName=study_id,
         datastoreId=DATASTORE_ID,
         dataAccessRoleArn=os.environ['HEALTHIMAGING_ROLE_ARN'],
         inputS3Uri=s3_uri,
@@ -123,30 +202,42 @@ def start_healthimaging_import(study_id, s3_uri):
 def save_to_dynamodb(metadata):
     """
     Save study metadata to DynamoDB
+    All study attributes are stored as strings
     """
-    table = dynamodb.Table(METADATA_TABLE)
-    table.put_item(Item=metadata)
+    dynamodb_client.put_item(
+        TableName=METADATA_TABLE,
+        Item={k: string_value(str(v)) for k, v in metadata.items()}
+    )
 
 
-def trigger_workflow(study_id, metadata):
+def update_study(study_id, **attributes):
     """
-    Trigger Step Functions workflow for processing
+    Set string attributes of a study saved by save_to_dynamodb
     """
-    sfn_client.start_execution(
-        stateMachineArn=STEP_FUNCTION_ARN,
-        name=f"stroke-analysis-{study_id}",
-        input=json.dumps(metadata)
+    dynamodb_client.update_item(
+        TableName=METADATA_TABLE,
+        Key={'study_id': string_value(study_id)},
+        UpdateExpression='SET ' + ', '.join(f'#{k} = :{k}' for k in attributes),
+        ExpressionAttributeNames={f'#{k}': k for k in attributes},
+        ExpressionAttributeValues={f':{k}': string_value(str(v)) for k, v in attributes.items()}
     )
 
 
+def string_value(value):
+    """
+    DynamoDB string AttributeValue
+    """
+    return {'S': value}
+
+
 # For local testing
 if __name__ == "__main__":
     test_event = {
-        'body': json.dumps({
+        'body': orjson.dumps({
             'patient_id': 'P123456',
             'study_description': 'Brain CT - Suspected Stroke',
-            'file_key': 'uploads/sample_brain_ct.dcm'
-        })
+            'file_key': f'uploads/{uuid.uuid4().hex}/sample_brain_ct.dcm'
+        }).decode()
     }
     
     print(lambda_handler(test_event, None))
@@ -0,0 +1,73 @@
+"""
+Lambda Function: Workflow Dispatcher
+Triggered by: DynamoDB Stream (new study metadata items)
+Purpose: Start the Step Functions workflow outside the upload request path
+"""
+
+import orjson
+import boto3
+import os
+from botocore.config import Config
+
+# Larger connection pool, TCP keepalive and adaptive retries for AWS clients
+boto_config = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 3}
+)
+
+sfn_client = boto3.client('stepfunctions', config=boto_config)
+
+STEP_FUNCTION_ARN = os.environ['STEP_FUNCTION_ARN']
+
+def lambda_handler(event, context):
+    """
+    Start one workflow execution per study inserted in DynamoDB
+    """
+    started = 0
+    for record in event['Records']:
+        if record['eventName'] != 'INSERT':
+            continue
+        
+        new_image = record['dynamodb']['NewImage']
+        # Study items only hold strings; TypeDeserializer would turn numbers
+        # into Decimal, which orjson can't serialize
+        metadata = {k: v['S'] for k, v in new_image.items() if 'S' in v}
+        
+        try:
+            trigger_workflow(metadata['study_id'], metadata)
+            started += 1
+        except sfn_client.exceptions.ExecutionAlreadyExists:
+            # Stream records are delivered at least once
+            print(f"Workflow for {metadata['study_id']} already started")
+    
+    return {'started': started}
+
+
+def trigger_workflow(study_id, metadata):
+    """
+    Trigger Step Functions workflow for processing
+    """
+    sfn_client.start_execution(
+        stateMachineArn=STEP_FUNCTION_ARN,
+        name=f"stroke-analysis-{study_id}",
+        input=orjson.dumps(metadata).decode()
+    )
+
+
+if __name__ == "__main__":
+    test_event = {
+        'Records': [{
+            'eventName': 'INSERT',
+            'dynamodb': {
+                'NewImage': {
+                    'study_id': {'S': 'STUDY-abc123'},
+                    'patient_id': {'S': 'P123456'},
+                    'datastore_id': {'S': '1234567890abcdef1234567890abcdef'},
+                    'status': {'S': 'IMPORTING'}
+                }
+            }
+        }]
+    }
+    
+    print(lambda_handler(test_event, None))
@@ -0,0 +1,177 @@
+from io import BytesIO
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (CTImageStorage, DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian,
+                         ImplicitVRLittleEndian, JPEG2000Lossless, generate_uid)
+
+import dicomImagestest
+from dicomImagestest import (HU_MAX, HU_MIN, classify_body_parts, decode_j2k_pixels, dense_class,
+                             has_file_pixel_data, has_j2k_pixel_data, has_raw_pixel_data,
+                             intra_cranial_fraction, intra_cranial_fractions, otsu_threshold)
+
+
+def skull_phantom(size=512, brain_radius=200, skull_radius=220):
+    """
+    Axial head slice: 40 HU brain inside a 1000 HU skull ring, air outside
+    """
+    y, x = np.ogrid[:size, :size]
+    radius = np.hypot(y - size / 2, x - size / 2)
+    hu = np.full((size, size), -1000, dtype=np.float32)
+    hu[radius < skull_radius] = 1000
+    hu[radius < brain_radius] = 40
+    return hu
+
+
+def test_intra_cranial_fraction_skull_phantom():
+    # Rays from off-centre voxels must reach the far side of the skull
+    fraction = intra_cranial_fraction(skull_phantom())
+    assert fraction > 0.99
+    assert classify_body_parts(fraction, 0, 0) == "BRAIN/HEAD"
+
+
+def test_intra_cranial_fractions_matches_single_slice():
+    # Compiled kernel (numba installed) or per-slice fallback, same rays
+    hu = skull_phantom()
+    volume = np.stack([hu, np.full_like(hu, 40)])
+    fractions = intra_cranial_fractions(volume)
+    np.testing.assert_allclose(fractions, [intra_cranial_fraction(hu), 0.0])
+    assert fractions[0] > 0.99
+
+
+def test_intra_cranial_fraction_without_skull():
+    hu = np.full((512, 512), 40, dtype=np.float32)
+    assert intra_cranial_fraction(hu) == 0.0
+
+
+def region_features(region):
+    """
+    Otsu threshold and dense class of a HU region, as main computes them
+    """
+    hist = np.bincount(np.clip(region, HU_MIN, HU_MAX).ravel().astype(np.int16) - HU_MIN,
+                       minlength=HU_MAX - HU_MIN + 1)
+    threshold = otsu_threshold(hist) + HU_MIN
+    return (threshold,) + dense_class(hist, threshold)
+
+
+def test_classify_bimodal_bone_region():
+    # Bone clipped into the last bin, the threshold lands on the tissue peak
+    region = np.where(np.arange(1000) < 700, 1000, 40)
+    threshold, dense_fraction, dense_mean = region_features(region)
+    assert dense_fraction == pytest.approx(0.7)
+    assert dense_mean >= 100
+    assert classify_body_parts(0.0, dense_mean, dense_fraction) == "BONE/SKULL"
+
+
+def test_classify_soft_tissue_region():
+    region = np.where(np.arange(1000) < 700, 60, 30)
+    threshold, dense_fraction, dense_mean = region_features(region)
+    assert classify_body_parts(0.0, dense_mean, dense_fraction) == "SOFT TISSUE"
+
+
+def test_decode_j2k_pixels_unsigned_codestream():
+    # Signed 12-bit CT values stored in an unsigned J2K codestream
+    openjpeg = pytest.importorskip("openjpeg")
+    pytest.importorskip("pylibjpeg")
+    hu = np.resize(np.array([-100, 0, 700, 1500], dtype=np.int16), (64, 64))
+    codestream = bytes(openjpeg.encode(hu.astype(np.uint16) & 0x0FFF, bits_stored=12,
+                                       photometric_interpretation=2, use_mct=False))
+    
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = JPEG2000Lossless
+    ds.Rows, ds.Columns = hu.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 1
+    ds.PixelData = encapsulate([codestream])
+    
+    assert has_j2k_pixel_data(ds)
+    np.testing.assert_array_equal(decode_j2k_pixels(ds), ds.pixel_array)
+    np.testing.assert_array_equal(decode_j2k_pixels(ds), hu)
+
+
+def test_has_j2k_pixel_data_colour():
+    # Colour frames are left to pixel_array
+    path = get_testdata_file("GDCMJ2K_TextGBR.dcm")
+    if path is None:
+        pytest.skip("pydicom test file not available")
+    ds = pydicom.dcmread(path)
+    assert ds.SamplesPerPixel == 3
+    assert not has_j2k_pixel_data(ds)
+
+
+@pytest.mark.parametrize("transfer_syntax, on_disk", [
+    (ExplicitVRLittleEndian, True),
+    (DeflatedExplicitVRLittleEndian, False),
+])
+def test_has_file_pixel_data(transfer_syntax, on_disk):
+    # GPU reads pixel bytes straight from the file, deflated ones need pydicom
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.BitsAllocated = 16
+    
+    assert has_raw_pixel_data(ds)
+    assert has_file_pixel_data(ds) == on_disk
+
+
+@pytest.mark.parametrize("samples_per_pixel, bits_allocated", [(3, 8), (1, 1), (1, 12)])
+def test_has_raw_pixel_data_unsupported_layout(samples_per_pixel, bits_allocated):
+    # Colour and packed bit layouts are left to pixel_array
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SamplesPerPixel = samples_per_pixel
+    ds.BitsAllocated = bits_allocated
+    
+    assert not has_raw_pixel_data(ds)
+    assert not has_file_pixel_data(ds)
+
+
+class FakeS3:
+    """
+    S3 client serving one in-memory DICOM file
+    """
+    def __init__(self, data):
+        self.data = data
+    
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range.removeprefix('bytes=').split('-'))
+        return {'Body': BytesIO(self.data[start:end + 1])}
+    
+    def download_fileobj(self, Bucket, Key, Fileobj, Config=None):
+        Fileobj.write(self.data)
+
+
+def test_main_header_cut_inside_sequence(monkeypatch, capsys):
+    # Undefined length sequence crossing HEADER_BYTES, tags follow it
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = CTImageStorage
+    ds.Modality = 'CT'
+    ds.ReferencedImageSequence = [Dataset() for _ in range(2000)]
+    for item in ds.ReferencedImageSequence:
+        item.ReferencedSOPClassUID = CTImageStorage
+        item.ReferencedSOPInstanceUID = generate_uid()
+    ds['ReferencedImageSequence'].is_undefined_length = True
+    ds.BodyPartExamined = 'HEAD'
+    
+    buffer = BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    assert buffer.tell() > dicomImagestest.HEADER_BYTES
+    
+    monkeypatch.setattr(dicomImagestest.boto3, 'client',
+                        lambda *args, **kwargs: FakeS3(buffer.getvalue()))
+    dicomImagestest.main()
+    assert "Detected Body Part: HEAD" in capsys.readouterr().out